@@ -1,19 +1,52 @@
 """Module with helper classes for ffmpeg2obj"""
 
 # pylint: disable=too-few-public-methods, too-many-instance-attributes, too-many-arguments
+# pylint: disable=import-outside-toplevel
+
+# boto3, botocore and ffmpeg are imported where used to keep CLI startup fast
 
 import argparse
+import errno
+import glob
 import hashlib
 import json
 import os
+import re
+import shutil
+import socket
+import stat
 import tempfile
 import time
 from datetime import timedelta
 from typing import Any, Optional
 
-import boto3
-import botocore
-import ffmpeg  # type: ignore[import-untyped]
+CROPDETECT_SAMPLES = 5
+CROPDETECT_SAMPLE_DURATION = 2
+CROPDETECT_PATTERN = re.compile(r"crop=(\d+):(\d+):(\d+):(\d+)")
+# crops removing fewer pixels per dimension are not worth the filter
+CROP_MIN_PIXELS = 16
+STAGED_DURATION_TOLERANCE = 1.0
+TEMP_FILE_PREFIX = "ffmpeg2obj-"
+PARTIAL_FILE_SUFFIX = ".part"
+PARAMS_FILE_SUFFIX = ".json"
+CHECKSUMS_FILE_SUFFIX = ".checksums.json"
+# partial outputs of other hosts are considered dead after this many idle seconds
+FOREIGN_PARTIAL_MAX_IDLE = 3600
+HOSTNAME = socket.gethostname()
+COPY_CHUNK_SIZE = 64 * 2**20
+UPLOAD_PART_SIZE = 8 * 2**20
+UPLOAD_MAX_PARTS = 10000
+# errors meaning that a copy method is not supported for given files
+COPY_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.ETXTBSY,
+}
+# linux ioctl number of FICLONE used for reflinks on CoW filesystems
+FICLONE = 0x40049409
 
 
 class SplitArgs(argparse.Action):
@@ -24,6 +57,28 @@ class SplitArgs(argparse.Action):
         setattr(namespace, self.dest, values.split(","))
 
 
+class AudioProfileArgs(argparse.Action):
+    """Custom argparse action parsing lang=codec[:bitrate[:channels]] profiles"""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        audio_profiles = dict(getattr(namespace, self.dest) or {})
+        lang, _, profile = values.partition("=")
+        codec, bitrate, channels = (profile.split(":") + [None, None])[:3]
+        if not lang or not codec:
+            parser.error(
+                f"argument {option_string}: expected lang=codec[:bitrate[:channels]]"
+            )
+        try:
+            audio_profiles[lang] = {
+                "codec": codec,
+                "bitrate": bitrate or None,
+                "channels": int(channels) if channels else None,
+            }
+        except ValueError:
+            parser.error(f"argument {option_string}: invalid channels in {values}")
+        setattr(namespace, self.dest, audio_profiles)
+
+
 class ProcessingParams:
     """Class to describe processing parameres"""
 
@@ -39,6 +94,12 @@ class ProcessingParams:
         target_qp: int,
         target_crf: int,
         preset: str | None,
+        autocrop: bool,
+        audio_codec: str,
+        audio_bitrate: str | None,
+        audio_channels: int | None,
+        keep_first_audio: bool,
+        audio_profiles: dict[str, dict[str, Any]],
     ) -> None:
         self.resize = resize
         self.video_codec = video_codec
@@ -48,6 +109,12 @@ class ProcessingParams:
         self.target_qp = target_qp
         self.target_crf = target_crf
         self.preset = preset
+        self.autocrop = autocrop
+        self.audio_codec = audio_codec
+        self.audio_bitrate = audio_bitrate
+        self.audio_channels = audio_channels
+        self.keep_first_audio = keep_first_audio
+        self.audio_profiles = audio_profiles
         self.target_res: list[int] = [target_width, target_height]
 
     def to_json_str(self):
@@ -58,6 +125,30 @@ class ProcessingParams:
 class ProcessedFile:
     """Class to describe processed files"""
 
+    __slots__ = (
+        "object_name",
+        "real_paths",
+        "file_extension",
+        "dst_dir",
+        "has_lockfile",
+        "is_uploaded",
+        "processing_params",
+        "hashed_name",
+        "object_lock_file_name",
+        "dst_path",
+        "dst_hashed_path",
+        "dst_partial_path",
+        "dst_params_path",
+        "dst_checksums_path",
+        "probe_result",
+        "crop_result",
+        "stream",
+        "input_file",
+        "concat_enabled",
+        "is_staged",
+        "checksums",
+    )
+
     def __init__(
         self,
         object_name: str,
@@ -81,8 +172,22 @@ class ProcessedFile:
         self.dst_hashed_path: str = (
             self.dst_dir + self.hashed_name + "." + self.file_extension
         )
+        # output is written under the owning host and pid and renamed once complete
+        self.dst_partial_path: str = (
+            f"{self.dst_dir}{self.hashed_name}.{HOSTNAME}.{os.getpid()}"
+            f"{PARTIAL_FILE_SUFFIX}.{self.file_extension}"
+        )
+        self.dst_params_path: str = self.dst_hashed_path + PARAMS_FILE_SUFFIX
+        # checksums which could not be stored on the lock file yet
+        self.dst_checksums_path: str = self.dst_hashed_path + CHECKSUMS_FILE_SUFFIX
         self.probe_result: Optional[dict] = None
-        self.stream, self.input_file, self.concat_enabled = self._build_ffmpeg_command()
+        self.crop_result: Optional[list[int]] = None
+        # ffmpeg command is built on first use to keep planned jobs lightweight
+        self.stream: Any = None
+        self.input_file: Optional[str] = None
+        self.concat_enabled: bool = len(self.real_paths) > 1
+        self.is_staged: bool = False
+        self.checksums: dict[str, str] = {}
 
     def __str__(self) -> str:
         out = []
@@ -90,6 +195,7 @@ class ProcessedFile:
         out += ["real_path: " + ",".join(self.real_paths)]
         out += ["has_lockfile: " + str(self.has_lockfile)]
         out += ["is_uploaded: " + str(self.is_uploaded)]
+        out += ["is_staged: " + str(self.is_staged)]
         out += ["hashed_name: " + self.hashed_name]
         return "\n".join(out)
 
@@ -106,23 +212,196 @@ class ProcessedFile:
         if uploaded_file_exist is not None:
             self.is_uploaded = uploaded_file_exist
 
-    def get_coded_res(self) -> list[int]:
-        """Returns height and width for the file from real_path"""
+    def get_probe_result(self) -> dict:
+        """Returns cached ffprobe result for the first file from real_paths"""
         if self.probe_result is None:
+            import ffmpeg  # type: ignore[import-untyped]
+
             self.probe_result = ffmpeg.probe(self.real_paths[0])
+        return self.probe_result
+
+    def get_partial_files(self) -> list[tuple[str, bool]]:
+        """Returns paths of partial outputs in dst_dir and whether their writer is alive"""
+        partial_files = []
+        path_prefix = self.dst_dir + self.hashed_name + "."
+        path_suffix = f"{PARTIAL_FILE_SUFFIX}.{self.file_extension}"
+        pattern = glob.escape(path_prefix) + "*" + glob.escape(path_suffix)
+        for partial_path in glob.glob(pattern):
+            owner = partial_path.removeprefix(path_prefix).removesuffix(path_suffix)
+            host, _, pid = owner.rpartition(".")
+            if not host or not pid.isdigit():
+                continue
+            if host == HOSTNAME:
+                is_alive = pid_is_alive(int(pid))
+            else:
+                # pid of another host can not be checked, use activity instead
+                try:
+                    idle_time = time.time() - os.path.getmtime(partial_path)
+                except FileNotFoundError:
+                    continue
+                is_alive = idle_time < FOREIGN_PARTIAL_MAX_IDLE
+            partial_files.append((partial_path, is_alive))
+        return partial_files
+
+    def staged_params_match(self) -> bool:
+        """Checks whether staged file was converted with current processing params"""
+        try:
+            with open(self.dst_params_path, encoding="utf8") as params_file:
+                staged_params = params_file.read()
+        except FileNotFoundError:
+            return False
+        return staged_params == self.processing_params.to_json_str()
+
+    def remove_staged_params(self) -> None:
+        """Removes processing params recorded next to the staged file"""
+        try:
+            os.remove(self.dst_params_path)
+        except FileNotFoundError:
+            pass
+
+    def get_source_durations(self) -> list[float] | None:
+        """Returns durations of the files from real_paths in seconds"""
+        import ffmpeg  # type: ignore[import-untyped]
+
+        try:
+            durations = [float(self.get_probe_result()["format"]["duration"])]
+            for real_path in self.real_paths[1:]:
+                durations.append(float(ffmpeg.probe(real_path)["format"]["duration"]))
+        except (ffmpeg.Error, KeyError, ValueError):
+            return None
+        return durations
+
+    def get_source_duration(self) -> float | None:
+        """Returns total duration of the files from real_paths in seconds"""
+        durations = self.get_source_durations()
+        if durations is None:
+            return None
+        return sum(durations)
+
+    def staged_file_is_complete(self) -> bool:
+        """Checks whether file at dst_hashed_path matches source duration"""
+        import ffmpeg  # type: ignore[import-untyped]
+
+        if not os.path.isfile(self.dst_hashed_path):
+            return False
+        source_duration = self.get_source_duration()
+        if source_duration is None:
+            return False
+        try:
+            staged_probe = ffmpeg.probe(self.dst_hashed_path)
+            staged_duration = float(staged_probe["format"]["duration"])
+        except (ffmpeg.Error, KeyError, ValueError):
+            return False
+        return abs(source_duration - staged_duration) <= STAGED_DURATION_TOLERANCE
+
+    def get_coded_res(self) -> list[int]:
+        """Returns height and width for the file from real_path"""
+        probe_result = self.get_probe_result()
         video_stream = list(
-            filter(lambda x: x["codec_type"] == "video", self.probe_result["streams"])
+            filter(lambda x: x["codec_type"] == "video", probe_result["streams"])
         )[0]
         coded_res = [video_stream["coded_width"], video_stream["coded_height"]]
         return coded_res
 
-    def _build_ffmpeg_command(self) -> tuple[Any, str, bool]:
-        """Builds the ffmpeg stream and input path for conversion."""
+    def get_res(self) -> list[int]:
+        """Returns displayed width and height for the file from real_path"""
+        probe_result = self.get_probe_result()
+        video_stream = list(
+            filter(lambda x: x["codec_type"] == "video", probe_result["streams"])
+        )[0]
+        return [video_stream["width"], video_stream["height"]]
+
+    def get_crop(self) -> list[int] | None:
+        """Returns width, height, x and y of the picture area detected with cropdetect"""
+        import ffmpeg  # type: ignore[import-untyped]
+
+        if self.crop_result is not None:
+            return self.crop_result
+        durations = self.get_source_durations()
+        if durations is None:
+            return None
+        crop_boxes = []
+        for sample in range(1, CROPDETECT_SAMPLES + 1):
+            # samples are spread over all concatenated parts
+            sample_start = sum(durations) * sample / (CROPDETECT_SAMPLES + 1)
+            sample_path = self.real_paths[-1]
+            for real_path, duration in zip(self.real_paths, durations):
+                if sample_start < duration:
+                    sample_path = real_path
+                    break
+                sample_start -= duration
+            try:
+                _, std_err = (
+                    ffmpeg.input(
+                        sample_path,
+                        ss=sample_start,
+                        t=CROPDETECT_SAMPLE_DURATION,
+                    )
+                    .filter("cropdetect", round=2)
+                    .output("-", f="null")
+                    .run(capture_stdout=True, capture_stderr=True)
+                )
+            except ffmpeg.Error as e:
+                print(f"Error occured: {e}")
+                continue
+            detected = CROPDETECT_PATTERN.findall(std_err.decode())
+            if detected:
+                crop_boxes.append([int(x) for x in detected[-1]])
+        if not crop_boxes:
+            return None
+        # union of detected boxes so that no sample loses picture area
+        left = min(box[2] for box in crop_boxes)
+        top = min(box[3] for box in crop_boxes)
+        right = max(box[2] + box[0] for box in crop_boxes)
+        bottom = max(box[3] + box[1] for box in crop_boxes)
+        self.crop_result = [right - left, bottom - top, left, top]
+        return self.crop_result
+
+    def get_output_audio_langs(self, langs: list[str] | None) -> list[str | None]:
+        """Returns language of each output audio track in output order"""
+        if langs is None:
+            # without explicit mapping ffmpeg selects a single audio track
+            return [None]
+        probe_result = self.get_probe_result()
+        audio_langs = [
+            stream.get("tags", {}).get("language")
+            for stream in probe_result["streams"]
+            if stream["codec_type"] == "audio"
+        ]
+        # each language map adds its matching tracks in input order
+        return [
+            lang for lang in langs for audio_lang in audio_langs if audio_lang == lang
+        ]
+
+    def get_first_audio_indexes(self, langs: list[str] | None) -> list[int]:
+        """Returns output indexes of the first audio track for each language"""
+        output_audio_langs = self.get_output_audio_langs(langs)
+        return [
+            index
+            for index, lang in enumerate(output_audio_langs)
+            if output_audio_langs.index(lang) == index
+        ]
+
+    def get_stream(self) -> Any:
+        """Returns ffmpeg stream for conversion, builds it on first use"""
+        if self.stream is None:
+            self.stream, self.input_file, self.concat_enabled = (
+                self._build_ffmpeg_command()
+            )
+        return self.stream
+
+    def _build_ffmpeg_command(self, dry_run: bool = False) -> tuple[Any, str, bool]:
+        """Builds the ffmpeg stream and input path for conversion.
+
+        With dry_run no cropdetect passes are run and no concat list is written.
+        """
+        import ffmpeg  # type: ignore[import-untyped]
+
         concat_enabled = len(self.real_paths) > 1
         # core opts
         opts_dict: dict[str, Any] = {
             "c:v": self.processing_params.video_codec,
-            "c:a": "copy",
+            "c:a": self.processing_params.audio_codec,
             "c:s": "copy",
             "v": "error",
         }
@@ -141,79 +420,187 @@ class ProcessedFile:
             and self.processing_params.video_codec != "copy"
         ):
             opts_dict.update({"preset": self.processing_params.preset})
+        langs: list[str] | None = None
         if self.processing_params.langs != ["all"]:
-            requested_langs = set(self.processing_params.langs)
+            # keep requested order as it defines output stream order
+            requested_langs = list(dict.fromkeys(self.processing_params.langs))
             if self.processing_params.loose_langs:
-                langs = set()
-                if self.probe_result is None:
-                    self.probe_result = ffmpeg.probe(self.real_paths[0])
-                for stream in self.probe_result["streams"]:
+                found_langs = set()
+                probe_result = self.get_probe_result()
+                for stream in probe_result["streams"]:
                     try:
                         lang = stream["tags"]["language"]
                         if lang in requested_langs:
-                            langs.add(lang)
+                            found_langs.add(lang)
                     except KeyError:
                         pass
+                langs = [lang for lang in requested_langs if lang in found_langs]
             else:
                 langs = requested_langs
             lang_map = [f"0:m:language:{lang}" for lang in langs]
             opts_dict.update({"map": tuple(lang_map)})
+        if self.processing_params.audio_profiles:
+            # every track gets stream specific options so that profiles
+            # do not inherit global bitrate or channels
+            default_profile = {
+                "codec": self.processing_params.audio_codec,
+                "bitrate": self.processing_params.audio_bitrate,
+                "channels": self.processing_params.audio_channels,
+            }
+            for index, lang in enumerate(self.get_output_audio_langs(langs)):
+                profile = default_profile
+                if lang is not None:
+                    profile = self.processing_params.audio_profiles.get(
+                        lang, default_profile
+                    )
+                opts_dict.update({f"c:a:{index}": profile["codec"]})
+                if profile["codec"] == "copy":
+                    continue
+                if profile["bitrate"] is not None:
+                    opts_dict.update({f"b:a:{index}": profile["bitrate"]})
+                if profile["channels"] is not None:
+                    opts_dict.update({f"ac:a:{index}": str(profile["channels"])})
+        elif self.processing_params.audio_codec != "copy":
+            if self.processing_params.audio_bitrate is not None:
+                opts_dict.update({"b:a": self.processing_params.audio_bitrate})
+            if self.processing_params.audio_channels is not None:
+                opts_dict.update({"ac": str(self.processing_params.audio_channels)})
+        if self.processing_params.keep_first_audio and (
+            self.processing_params.audio_codec != "copy"
+            or self.processing_params.audio_profiles
+        ):
+            for index in self.get_first_audio_indexes(langs):
+                opts_dict.update({f"c:a:{index}": "copy"})
+                opts_dict.pop(f"b:a:{index}", None)
+                opts_dict.pop(f"ac:a:{index}", None)
+        video_filters = []
+        crop = None
         if (
-            self.processing_params.resize
-            and self.processing_params.target_res != self.get_coded_res()
+            self.processing_params.autocrop
+            and self.processing_params.video_codec != "copy"
+            and not dry_run
         ):
-            opts_dict.update(
-                {
-                    "vf": "scale="
+            crop = self.get_crop()
+            res = self.get_res()
+            if crop is not None and (
+                res[0] - crop[0] >= CROP_MIN_PIXELS
+                or res[1] - crop[1] >= CROP_MIN_PIXELS
+            ):
+                video_filters.append("crop=" + ":".join(str(x) for x in crop))
+            else:
+                crop = None
+        if self.processing_params.resize and (
+            crop is not None
+            or self.processing_params.target_res != self.get_coded_res()
+        ):
+            if crop is not None:
+                # fit cropped picture inside target resolution keeping its aspect ratio
+                video_filters.append(
+                    "scale="
                     + ":".join(str(x) for x in self.processing_params.target_res)
-                }
-            )
-        if concat_enabled:
+                    + ":force_original_aspect_ratio=decrease:force_divisible_by=2"
+                )
+            else:
+                video_filters.append(
+                    "scale="
+                    + ":".join(str(x) for x in self.processing_params.target_res)
+                )
+        if video_filters:
+            opts_dict.update({"vf": ",".join(video_filters)})
+        if concat_enabled and dry_run:
+            input_file = f"<concat list of {len(self.real_paths)} files>"
+            stream = ffmpeg.input(input_file, f="concat", safe="0")
+        elif concat_enabled:
             temp_file_byte_contents = (
                 "\n".join(f"file '{path}'" for path in self.real_paths) + "\n"
             ).encode()
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            with tempfile.NamedTemporaryFile(
+                prefix=f"{TEMP_FILE_PREFIX}{HOSTNAME}-{os.getpid()}-",
+                suffix=".txt",
+                delete=False,
+            ) as temp_file:
                 temp_file.write(temp_file_byte_contents)
             input_file = temp_file.name
             stream = ffmpeg.input(input_file, f="concat", safe="0")
         else:
             input_file = self.real_paths[0]
             stream = ffmpeg.input(input_file)
-        stream = ffmpeg.output(stream, self.dst_hashed_path, **opts_dict)
+        stream = ffmpeg.output(stream, self.dst_partial_path, **opts_dict)
         return stream, input_file, concat_enabled
 
-    def print_ffmpeg_command(self) -> None:
+    def print_ffmpeg_command(self, dry_run: bool = False) -> None:
         """Prints ffmpeg command for debugging purposes"""
-        print(" ".join(ffmpeg.compile(self.stream)))
+        import ffmpeg  # type: ignore[import-untyped]
+
+        if dry_run and self.stream is None:
+            stream, _, _ = self._build_ffmpeg_command(dry_run=True)
+            print(" ".join(ffmpeg.compile(stream)))
+            if (
+                self.processing_params.autocrop
+                and self.processing_params.video_codec != "copy"
+            ):
+                print("crop filter is omitted, it is detected during conversion")
+        else:
+            print(" ".join(ffmpeg.compile(self.get_stream())))
 
     def convert(self) -> tuple[str, str, bool, timedelta]:
         """Runs ffmpeg against the file from real_path and stores it in /tmp"""
+        import ffmpeg  # type: ignore[import-untyped]
+
         convert_succeded = False
         start_time = time.monotonic()
         try:
             std_out, std_err = ffmpeg.run(
-                self.stream, capture_stdout=True, capture_stderr=True
+                self.get_stream(), capture_stdout=True, capture_stderr=True
             )
         except ffmpeg.Error as e:
             print(f"Error occured: {e}")
+            if self.concat_enabled and self.input_file is not None:
+                os.remove(self.input_file)
+            if os.path.isfile(self.dst_partial_path):
+                os.remove(self.dst_partial_path)
             end_time = time.monotonic()
             duration = timedelta(seconds=end_time - start_time)
             return e.stdout.decode(), e.stderr.decode(), convert_succeded, duration
+        with open(self.dst_params_path, "w", encoding="utf8") as params_file:
+            params_file.write(self.processing_params.to_json_str())
+        os.replace(self.dst_partial_path, self.dst_hashed_path)
         convert_succeded = True
-        if self.concat_enabled:
+        if self.concat_enabled and self.input_file is not None:
             os.remove(self.input_file)
         end_time = time.monotonic()
         duration = timedelta(seconds=end_time - start_time)
         return std_out.decode(), std_err.decode(), convert_succeded, duration
 
+    def get_source_fingerprint(self) -> str:
+        """Returns hash of object name, file names, sizes and modification times"""
+        # real_paths depend on how source dir was given, object_name does not
+        hasher = hashlib.sha256()
+        hasher.update(f"{self.object_name}\n".encode("utf8"))
+        for real_path in self.real_paths:
+            source_stat = os.stat(real_path)
+            source_name = os.path.basename(real_path)
+            hasher.update(
+                f"{source_name}:{source_stat.st_size}:{source_stat.st_mtime_ns}\n".encode(
+                    "utf8"
+                )
+            )
+        return hasher.hexdigest()
+
     def create_lock_file(self, obj_config: dict, bucket_name: str) -> bool:
-        """Creates empty lock file on object storage bucket"""
+        """Creates lock file with processing params and checksums on object storage bucket"""
+        import boto3
+        import botocore
+
         obj_client = boto3.client("s3", **obj_config)
+        metadata = {"source-fingerprint": self.get_source_fingerprint()}
+        metadata.update(self.checksums)
         try:
             obj_client.put_object(
                 Bucket=bucket_name,
                 Key=self.object_lock_file_name,
                 Body=self.processing_params.to_json_str().encode("UTF-8"),
+                Metadata=metadata,
             )
         except botocore.exceptions.ClientError as e:
             print(e)
@@ -223,22 +610,283 @@ class ProcessedFile:
 
     def upload(self, obj_config: dict, bucket_name: str) -> tuple[bool, timedelta]:
         """Uploads converted file from /tmp to object storage bucket"""
+        import boto3
+        import botocore
+        from boto3.s3.transfer import TransferConfig
+
         obj_client = boto3.client("s3", **obj_config)
         start_time = time.monotonic()
+        file_size = os.path.getsize(self.dst_hashed_path)
+        part_size = get_upload_part_size(file_size)
+        transfer_config = TransferConfig(
+            multipart_threshold=part_size, multipart_chunksize=part_size
+        )
         try:
-            obj_client.upload_file(self.dst_hashed_path, bucket_name, self.object_name)
-        except botocore.exceptions.ClientError as e:
+            with open(self.dst_hashed_path, "rb") as staged_file:
+                checksum_reader = ChecksumReader(staged_file, part_size)
+                obj_client.upload_fileobj(
+                    checksum_reader,
+                    bucket_name,
+                    self.object_name,
+                    Config=transfer_config,
+                )
+            self.checksums = checksum_reader.get_checksums()
+        except (
+            botocore.exceptions.ClientError,
+            boto3.exceptions.S3UploadFailedError,
+        ) as e:
             print(e)
         else:
             self.is_uploaded = True
         finally:
             end_time = time.monotonic()
             duration = timedelta(seconds=end_time - start_time)
+        if self.is_uploaded:
+            try:
+                uploaded_object = obj_client.head_object(
+                    Bucket=bucket_name, Key=self.object_name
+                )
+            except botocore.exceptions.ClientError as e:
+                print(f"Could not verify ETag of {self.object_name}: {e}")
+            else:
+                if uploaded_object["ETag"].strip('"') != self.checksums["etag"]:
+                    print(
+                        f"ETag of {self.object_name} differs from the locally computed one,"
+                        " object storage may use encryption or a different part size"
+                    )
+            # store checksums next to processing params for later verification
+            if not self.create_lock_file(obj_config, bucket_name):
+                print(
+                    f"Could not store checksums of {self.object_name},"
+                    " will retry on the next run"
+                )
+                with open(self.dst_checksums_path, "w", encoding="utf8") as f:
+                    json.dump(self.checksums, f)
         return self.is_uploaded, duration
 
+    def has_pending_checksums(self) -> bool:
+        """Checks whether checksums still wait to be stored on the lock file"""
+        return os.path.isfile(self.dst_checksums_path)
+
+    def store_pending_checksums(self, obj_config: dict, bucket_name: str) -> bool:
+        """Stores checksums recorded by a previous run on the lock file"""
+        with open(self.dst_checksums_path, encoding="utf8") as f:
+            self.checksums = json.load(f)
+        if not self.create_lock_file(obj_config, bucket_name):
+            return False
+        os.remove(self.dst_checksums_path)
+        return True
+
+
+class ChecksumReader:
+    """Read only file wrapper which computes checksums of the bytes read through it"""
+
+    def __init__(self, fileobj: Any, part_size: int) -> None:
+        self.fileobj = fileobj
+        self.part_size = part_size
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.part_md5 = hashlib.md5(usedforsecurity=False)
+        self.part_position = 0
+        self.part_digests: list[bytes] = []
+
+    def read(self, amount: int = -1) -> bytes:
+        """Reads from wrapped file and updates checksums"""
+        data = self.fileobj.read(amount)
+        self.size += len(data)
+        self.sha256.update(data)
+        view = memoryview(data)
+        while view:
+            part_remaining = min(len(view), self.part_size - self.part_position)
+            self.part_md5.update(view[:part_remaining])
+            self.part_position += part_remaining
+            view = view[part_remaining:]
+            if self.part_position == self.part_size:
+                self.part_digests.append(self.part_md5.digest())
+                self.part_md5 = hashlib.md5(usedforsecurity=False)
+                self.part_position = 0
+        return data
+
+    def get_etag(self) -> str:
+        """Returns ETag expected from object storage for the data read so far"""
+        if self.size < self.part_size:
+            return self.part_md5.hexdigest()
+        part_digests = self.part_digests
+        if self.part_position > 0:
+            part_digests = part_digests + [self.part_md5.digest()]
+        etag_hasher = hashlib.md5(usedforsecurity=False)
+        etag_hasher.update(b"".join(part_digests))
+        return f"{etag_hasher.hexdigest()}-{len(part_digests)}"
+
+    def get_checksums(self) -> dict[str, str]:
+        """Returns checksums in a form suitable for object metadata"""
+        return {
+            "sha256": self.sha256.hexdigest(),
+            "etag": self.get_etag(),
+            "part-size": str(self.part_size),
+            "size": str(self.size),
+        }
+
+
+def get_upload_part_size(file_size: int) -> int:
+    """Returns multipart upload part size which keeps part count within limits"""
+    part_size = UPLOAD_PART_SIZE
+    while part_size * UPLOAD_MAX_PARTS < file_size:
+        part_size *= 2
+    return part_size
+
+
+class RecoveryReport:
+    """Class to describe results of crash recovery"""
+
+    def __init__(self) -> None:
+        self.reused_files: list[str] = []
+        self.removed_files: list[str] = []
+        self.reclaimed_bytes: int = 0
+
+    def is_empty(self) -> bool:
+        """Checks whether recovery reused or removed anything"""
+        return not self.reused_files and not self.removed_files
+
+    def __str__(self) -> str:
+        out = []
+        out += ["reused staged files: " + str(len(self.reused_files))]
+        out += ["removed files: " + str(len(self.removed_files))]
+        out += [f"reclaimed space: {self.reclaimed_bytes / 2**20:.1f} MiB"]
+        return "\n".join(out)
+
+    def remove(self, path: str, noop: bool) -> None:
+        """Removes leftover regular file and records reclaimed space"""
+        try:
+            path_stat = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISREG(path_stat.st_mode):
+            return
+        if noop:
+            print(f"Would have removed leftover file {path}")
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already cleaned up by an overlapping run
+                return
+            print(f"Removed leftover file {path}")
+        self.removed_files.append(path)
+        self.reclaimed_bytes += path_stat.st_size
+
+
+def remove_stale_temp_files(report: RecoveryReport, noop: bool) -> None:
+    """Removes concat list files left behind by ffmpeg2obj runs no longer alive"""
+    temp_dir = tempfile.gettempdir()
+    for name in os.listdir(temp_dir):
+        # only pids of this host can be checked
+        host_prefix = f"{TEMP_FILE_PREFIX}{HOSTNAME}-"
+        if not name.startswith(host_prefix):
+            continue
+        try:
+            pid = int(name.removeprefix(host_prefix).split("-")[0])
+        except ValueError:
+            continue
+        if not pid_is_alive(pid):
+            report.remove(os.path.join(temp_dir, name), noop)
+
+
+def pid_is_alive(pid: int) -> bool:
+    """Checks whether process with given pid is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists but belongs to another user
+        return True
+    return True
+
+
+def move_file(src_path: str, dst_path: str) -> str:
+    """Moves file with the cheapest available method and returns its name"""
+    try:
+        os.rename(src_path, dst_path)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    part_path = dst_path + ".part"
+    try:
+        with open(src_path, "rb") as src_file, open(part_path, "wb") as dst_file:
+            method = copy_file(src_file.fileno(), dst_file.fileno())
+        shutil.copystat(src_path, part_path)
+        os.replace(part_path, dst_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.remove(src_path)
+    return method
+
+
+def copy_file(src_fd: int, dst_fd: int) -> str:
+    """Copies file contents in kernel space where possible and returns method name"""
+    try:
+        import fcntl
+
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return "reflink"
+    except ImportError:
+        pass
+    except OSError as e:
+        if e.errno not in COPY_UNSUPPORTED_ERRNOS | {errno.ENOTTY}:
+            raise
+    remaining = os.fstat(src_fd).st_size
+    copied = 0
+    method = "copy_file_range"
+    try:
+        while remaining > 0:
+            chunk = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, remaining))
+            if chunk == 0:
+                break
+            copied += chunk
+            remaining -= chunk
+    except AttributeError:
+        method = "sendfile"
+    except OSError as e:
+        if e.errno not in COPY_UNSUPPORTED_ERRNOS:
+            raise
+        method = "sendfile"
+    try:
+        while remaining > 0:
+            method = "sendfile"
+            chunk = os.sendfile(dst_fd, src_fd, copied, min(COPY_CHUNK_SIZE, remaining))
+            if chunk == 0:
+                break
+            copied += chunk
+            remaining -= chunk
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno not in COPY_UNSUPPORTED_ERRNOS:
+            raise
+        method = "read/write"
+        os.lseek(src_fd, copied, os.SEEK_SET)
+        os.lseek(dst_fd, copied, os.SEEK_SET)
+        while remaining > 0:
+            data = os.read(src_fd, min(COPY_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            written = 0
+            while written < len(data):
+                # os.write may write less than requested
+                written += os.write(dst_fd, data[written:])
+            remaining -= len(data)
+    if remaining > 0:
+        raise OSError(errno.EIO, "source file shrank during copy")
+    return method
+
 
 def file_exists_in_bucket(file: str, obj_config: dict, bucket_name: str) -> bool | None:
     """Checks if given file exists in requested bucket"""
+    import boto3
+    import botocore
+
     obj_client = boto3.client("s3", **obj_config)
     try:
         obj_client.head_object(Bucket=bucket_name, Key=file)
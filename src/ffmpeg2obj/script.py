@@ -2,31 +2,40 @@
 Main executable for simple project that compresses blu ray movie library and stores it in obj
 """
 
-# pylint: disable=too-many-arguments,too-many-locals
+# pylint: disable=too-many-arguments,too-many-locals,import-outside-toplevel
 
 import argparse
 import os
-import shutil
 import sys
 import unicodedata
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 from threading import Lock
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
 
-import boto3
-import botocore
+from ffmpeg2obj.helper import (
+    AudioProfileArgs,
+    ProcessedFile,
+    ProcessingParams,
+    RecoveryReport,
+    SplitArgs,
+    move_file,
+    remove_stale_temp_files,
+)
 
-from ffmpeg2obj.helper import ProcessedFile, ProcessingParams, SplitArgs
+if TYPE_CHECKING:
+    import boto3
 
-OBJ_ACCESS_KEY_ID = os.environ.get("aws_access_key_id", None)
-OBJ_SECRET_ACCESS_KEY = os.environ.get("aws_secret_access_key", None)
-OBJ_ENDPOINT_URL = os.environ.get("endpoint_url", None)
+MAX_WORKERS = 3
 
-OBJ_CONFIG = {
-    "aws_access_key_id": OBJ_ACCESS_KEY_ID,
-    "aws_secret_access_key": OBJ_SECRET_ACCESS_KEY,
-    "endpoint_url": OBJ_ENDPOINT_URL,
-}
+
+def get_obj_config() -> dict:
+    """Returns object storage config based on environment variables"""
+    return {
+        "aws_access_key_id": os.environ.get("aws_access_key_id", None),
+        "aws_secret_access_key": os.environ.get("aws_secret_access_key", None),
+        "endpoint_url": os.environ.get("endpoint_url", None),
+    }
 
 
 def parse_args() -> argparse.Namespace:
@@ -130,6 +139,46 @@ def parse_args() -> argparse.Namespace:
         help="ffmpeg preset for the selected video codec",
     )
 
+    parser.add_argument(
+        "-ac",
+        "--audio-codec",
+        dest="audio_codec",
+        type=str,
+        default="copy",
+        help="audio codec for transcoding of the media files",
+    )
+
+    parser.add_argument(
+        "--audio-bitrate",
+        dest="audio_bitrate",
+        type=str,
+        help="audio bitrate for transcoded audio tracks, e.g. 192k",
+    )
+
+    parser.add_argument(
+        "--audio-channels",
+        dest="audio_channels",
+        type=int,
+        help="number of channels to downmix transcoded audio tracks to",
+    )
+
+    parser.add_argument(
+        "--audio-profile",
+        dest="audio_profiles",
+        action=AudioProfileArgs,
+        default={},
+        help="per language audio profile as lang=codec[:bitrate[:channels]] replacing"
+        " global audio options for that language, can be repeated, requires explicit languages",
+    )
+
+    parser.add_argument(
+        "--keep-first-audio",
+        dest="keep_first_audio",
+        action="store_true",
+        default=False,
+        help="copies first audio track of each language without transcoding",
+    )
+
     parser.add_argument(
         "--pix-fmt",
         dest="pix_fmt",
@@ -171,6 +220,14 @@ def parse_args() -> argparse.Namespace:
         help="scale input files to height x width",
     )
 
+    parser.add_argument(
+        "--autocrop",
+        dest="autocrop",
+        action="store_true",
+        default=False,
+        help="detects black bars with cropdetect and crops them out",
+    )
+
     parser.add_argument(
         "--concat",
         dest="concat",
@@ -221,7 +278,11 @@ def parse_args() -> argparse.Namespace:
         help="Constant Rate Factor for the media files to be transcoded",
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.audio_profiles and args.langs == ["all"]:
+        # without language mapping output audio tracks can not be matched to profiles
+        parser.error("argument --audio-profile: requires explicit --languages")
+    return args
 
 
 def get_source_files(
@@ -230,56 +291,43 @@ def get_source_files(
     obj_prefix: str,
     file_extension: str,
     concat: bool,
-) -> dict[str, list[str]]:
-    """Looks for source files, performs concatenation of files in same directories if requested"""
-
-    def get_concat_base(object_name):
-        return "/".join(object_name.split("/")[:-1])
-
-    found_source_files: dict[str, str] = {}
+) -> Iterator[tuple[str, list[str]]]:
+    """Yields source files, performs concatenation of files in same directories if requested"""
     for root, _, files in os.walk(src_dir):
+        if ignored_subdir in root:
+            continue
+        # os.walk lists whole directory at once so concatenation can be streamed
+        found_source_files: dict[str, str] = {}
         for name in files:
-            if ignored_subdir not in root and name.lower().endswith(
-                file_extension.lower()
-            ):
+            if name.lower().endswith(file_extension.lower()):
                 real_path = unicodedata.normalize("NFC", os.path.join(root, name))
                 object_name = unicodedata.normalize(
                     "NFC", real_path.replace(src_dir, obj_prefix)
                 )
-                source_file_dict = {object_name: real_path}
-                found_source_files.update(source_file_dict)
-
-    source_files: dict[str, list[str]] = {}
-    if concat:
-        concat_base_mapping: dict[str, str] = {}
-        concat_object_name_mapping: dict[str, str] = {}
-        for object_name, real_path in found_source_files.items():
-            concat_base = get_concat_base(object_name)
-            concat_base_mapping.update({real_path: concat_base})
-            if concat_object_name_mapping.get(concat_base) is None:
-                concat_object_name_mapping.update({concat_base: object_name})
-        for real_path, concat_base in concat_base_mapping.items():
-            object_name = concat_object_name_mapping.get(concat_base)
-            if source_files.get(object_name) is None:
-                source_files.update({object_name: [real_path]})
-            else:
-                source_files.get(object_name).append(real_path)
-    else:
-        for object_name, real_path in found_source_files.items():
-            source_files.update({object_name: [real_path]})
-    return source_files
+                found_source_files.update({object_name: real_path})
+        if not found_source_files:
+            continue
+        if concat:
+            yield next(iter(found_source_files)), list(found_source_files.values())
+        else:
+            for object_name, real_path in found_source_files.items():
+                yield object_name, [real_path]
 
 
-def get_obj_resource(obj_config: dict) -> boto3.resource.__class__:
+def get_obj_resource(obj_config: dict) -> "boto3.resource.__class__":
     """Returns object storage client"""
+    import boto3
+
     obj_resource = boto3.resource("s3", **obj_config)
     return obj_resource
 
 
 def selected_bucket_exist(
-    obj_resource: boto3.resource.__class__, bucket_name: str
+    obj_resource: "boto3.resource.__class__", bucket_name: str
 ) -> bool:
     """Checks whether selected bucket exists"""
+    import botocore
+
     try:
         buckets = obj_resource.buckets.all()
         bucket_exists = bucket_name in list(bucket.name for bucket in buckets)
@@ -290,60 +338,118 @@ def selected_bucket_exist(
 
 
 def get_bucket_files(
-    obj_resource: boto3.resource.__class__, bucket_name: str | None
-) -> list[str] | None:
-    """Returns objects from given object storage bucket"""
-    bucket_files: list[str] = []
-    if bucket_name is None:
-        return None
-    if not selected_bucket_exist(obj_resource, bucket_name):
-        return None
-    bucket_files += list(
+    obj_resource: "boto3.resource.__class__", bucket_name: str, prefix: str
+) -> set[str]:
+    """Returns objects directly under given prefix from object storage bucket"""
+    bucket_files = set(
         unicodedata.normalize("NFC", file.key)
-        for file in obj_resource.Bucket(bucket_name).objects.all()
+        for file in obj_resource.Bucket(bucket_name).objects.filter(
+            Prefix=prefix, Delimiter="/"
+        )
     )
     return bucket_files
 
 
 def get_processed_files(
-    source_files: dict[str, list[str]],
-    bucket_objects: list,
+    source_files: Iterable[tuple[str, list[str]]],
+    obj_resource: Any,
+    bucket_name: str | None,
     source_file_extension: str,
     target_file_extension: str,
     dst_dir: str,
     processing_params: ProcessingParams,
-) -> list[ProcessedFile]:
-    """Returns list of processed files based on collected data"""
-    processed_files = []
-    for object_name, real_paths in source_files.items():
+) -> Iterator[ProcessedFile]:
+    """Yields processed files based on collected data"""
+    # bucket is listed per directory as source files are scanned directory by directory
+    bucket_prefix: str | None = None
+    bucket_objects: set[str] = set()
+    for object_name, real_paths in source_files:
         if source_file_extension != target_file_extension:
             target_object_name = object_name.replace(
                 source_file_extension, target_file_extension
             )
         else:
             target_object_name = object_name
-        is_uploaded = (
-            target_object_name in bucket_objects
-            if bucket_objects is not None
-            else False
+        is_uploaded = False
+        has_lockfile = False
+        if obj_resource is not None and bucket_name is not None:
+            object_dir = os.path.dirname(target_object_name)
+            # objects in bucket root are listed by their own name
+            prefix = object_dir + "/" if object_dir else target_object_name
+            if prefix != bucket_prefix:
+                bucket_objects = get_bucket_files(obj_resource, bucket_name, prefix)
+                bucket_prefix = prefix
+            is_uploaded = target_object_name in bucket_objects
+            has_lockfile = target_object_name + ".lock" in bucket_objects
+        yield ProcessedFile(
+            target_object_name,
+            real_paths,
+            target_file_extension,
+            dst_dir,
+            has_lockfile,
+            is_uploaded,
+            processing_params,
         )
-        has_lockfile = (
-            target_object_name + ".lock" in bucket_objects
-            if bucket_objects is not None
-            else False
-        )
-        processed_files.append(
-            ProcessedFile(
-                target_object_name,
-                real_paths,
-                target_file_extension,
-                dst_dir,
-                has_lockfile,
-                is_uploaded,
-                processing_params,
+
+
+def recover_staged_files(
+    processed_files: Iterable[ProcessedFile],
+    report: RecoveryReport,
+    noop: bool,
+) -> Iterator[ProcessedFile]:
+    """Reuses staged files matching current params, removes ones left by dead runs"""
+    for processed_file in processed_files:
+        in_progress = False
+        for partial_path, is_alive in processed_file.get_partial_files():
+            if is_alive:
+                in_progress = True
+            else:
+                report.remove(partial_path, noop)
+        if in_progress:
+            print(
+                f"File {processed_file.object_name} is being converted by another run"
             )
-        )
-    return processed_files
+            continue
+        # staged files are renamed into place only after successful conversion
+        if os.path.isfile(processed_file.dst_hashed_path):
+            if processed_file.is_uploaded and processed_file.has_lockfile:
+                report.remove(processed_file.dst_hashed_path, noop)
+                report.remove(processed_file.dst_params_path, noop)
+            elif (
+                processed_file.staged_params_match()
+                and processed_file.staged_file_is_complete()
+            ):
+                print(f"Reusing staged file for {processed_file.object_name}")
+                processed_file.is_staged = True
+                report.reused_files.append(processed_file.dst_hashed_path)
+            else:
+                report.remove(processed_file.dst_hashed_path, noop)
+                report.remove(processed_file.dst_params_path, noop)
+                # output has to be converted again despite the lock file
+                processed_file.has_lockfile = False
+        yield processed_file
+
+
+def skip_finished_files(
+    processed_files: Iterable[ProcessedFile],
+    obj_config: dict,
+    bucket_name: str | None,
+    noop: bool,
+) -> Iterator[ProcessedFile]:
+    """Yields processed files that still need work"""
+    for processed_file in processed_files:
+        if processed_file.is_uploaded and processed_file.has_lockfile:
+            print(f"File {processed_file.object_name} is already uploaded")
+            if processed_file.has_pending_checksums() and bucket_name is not None:
+                if noop:
+                    print(
+                        "Would have stored pending checksums for "
+                        + processed_file.object_name
+                    )
+                elif processed_file.store_pending_checksums(obj_config, bucket_name):
+                    print(f"Stored pending checksums for {processed_file.object_name}")
+            continue
+        yield processed_file
 
 
 def convert_and_upload(
@@ -386,7 +492,7 @@ def convert_and_upload(
             else:
                 print("Would have start conversion for " + processed_file.object_name)
                 if verbose:
-                    processed_file.print_ffmpeg_command()
+                    processed_file.print_ffmpeg_command(dry_run=True)
         return convert_succeded
 
     def upload(processed_file: ProcessedFile) -> bool:
@@ -406,6 +512,7 @@ def convert_and_upload(
                     )
                 if upload_succeded or force_cleanup:
                     os.remove(processed_file.dst_hashed_path)
+                    processed_file.remove_staged_params()
             else:
                 print("Would have start upload for " + processed_file.object_name)
         else:
@@ -431,7 +538,12 @@ def convert_and_upload(
             dst_path_parent_dir = os.path.dirname(processed_file.dst_path)
             if not os.path.exists(dst_path_parent_dir):
                 os.makedirs(dst_path_parent_dir)
-            shutil.move(processed_file.dst_hashed_path, processed_file.dst_path)
+            store_method = move_file(
+                processed_file.dst_hashed_path, processed_file.dst_path
+            )
+            processed_file.remove_staged_params()
+            if verbose:
+                print(f"Stored {processed_file.object_name} using {store_method}")
             store_succeded = True
         else:
             print(
@@ -454,7 +566,11 @@ def convert_and_upload(
     convert_succeded = False
     upload_succeded = False
     store_succeded = False
-    if needs_conversion(processed_file):
+    if processed_file.is_staged:
+        convert_succeded = True
+        if upload_enabled and not processed_file.has_lockfile and not noop:
+            processed_file.create_lock_file(obj_config, bucket_name)
+    elif needs_conversion(processed_file):
         convert_succeded = convert(processed_file)
     if upload_enabled:
         upload_succeded = upload(processed_file)
@@ -487,15 +603,17 @@ def main():
         args.concat,
     )
 
-    obj_resource = get_obj_resource(OBJ_CONFIG)
-    bucket_files = get_bucket_files(obj_resource, args.bucket_name)
+    obj_config = get_obj_config()
+    obj_resource = None
+    if args.upload_enabled:
+        obj_resource = get_obj_resource(obj_config)
 
-    if bucket_files is None and args.upload_enabled:
-        print(
-            f"Bucket {args.bucket_name} does not exist"
-            " or is not accessible with provided credentials"
-        )
-        sys.exit(4)
+        if not selected_bucket_exist(obj_resource, args.bucket_name):
+            print(
+                f"Bucket {args.bucket_name} does not exist"
+                " or is not accessible with provided credentials"
+            )
+            sys.exit(4)
 
     if args.noop:
         print("noop enabled, will not take any actions")
@@ -511,35 +629,49 @@ def main():
         args.target_qp,
         args.target_crf,
         args.preset,
+        args.autocrop,
+        args.audio_codec,
+        args.audio_bitrate,
+        args.audio_channels,
+        args.keep_first_audio,
+        args.audio_profiles,
     )
+    recovery_report = RecoveryReport()
+    remove_stale_temp_files(recovery_report, args.noop)
+
     processed_files = get_processed_files(
         source_files,
-        bucket_files,
+        obj_resource,
+        args.bucket_name,
         args.source_file_extension,
         args.file_extension,
         args.dst_dir,
         processing_params,
     )
-    jobs = Queue()
-    for file in processed_files:
-        jobs.put(file)
+    processed_files = recover_staged_files(processed_files, recovery_report, args.noop)
+    processed_files = skip_finished_files(
+        processed_files, obj_config, args.bucket_name, args.noop
+    )
+    # bounded queue keeps planning only slightly ahead of running jobs
+    jobs = Queue(maxsize=MAX_WORKERS)
     lock = Lock()
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        futures = [
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for processed_file in processed_files:
+            jobs.put(processed_file)
             executor.submit(
                 convert_and_upload,
                 jobs,
                 lock,
-                OBJ_CONFIG,
+                obj_config,
                 args.bucket_name,
                 args.force_cleanup,
                 args.noop,
                 args.verbose,
                 args.upload_enabled,
             )
-            for _ in range(len(processed_files))
-        ]
-    wait(futures)
+    if not recovery_report.is_empty():
+        print("Recovery summary:")
+        print(recovery_report)
 
 
 if __name__ == "__main__":